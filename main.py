@@ -10,22 +10,43 @@ Endpoints:
 """
 
 import os
-import hashlib
+import atexit
+import re
 import time
 import asyncio
+import threading
 import httpx
 from typing import Optional
-from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from cachetools import TTLCache
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 import yt_dlp
 
+# HTTP client для проксирования: HTTP/2 + keep-alive, чтобы повторные
+# запросы к одному CDN не платили за новый TCP+TLS handshake
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(30.0, read=300.0),
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100)
+    )
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+
+
 app = FastAPI(
     title="Video Downloader API",
     description="API for downloading videos from YouTube, VK, TikTok and other platforms",
-    version="1.5.0"
+    version="1.5.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 app.add_middleware(
@@ -36,17 +57,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-executor = ThreadPoolExecutor(max_workers=4)
+CACHE_TTL = 300
 
-# HTTP client для проксирования
-http_client = httpx.AsyncClient(
-    timeout=httpx.Timeout(30.0, read=300.0),
-    follow_redirects=True,
-    limits=httpx.Limits(max_connections=20)
-)
+# Ограниченный LRU-кэш с TTL: записи вытесняются сами, память не растёт
+video_cache = TTLCache(maxsize=1024, ttl=CACHE_TTL)
+video_cache_lock = threading.Lock()
 
-video_cache = {}
-CACHE_TTL = 300
+# Негативный кэш: повторы по заведомо битым URL (приватное/гео/удалённое
+# видео) отвечают сразу, не запуская извлечение заново. Сюда попадают
+# только детерминированные 403/404 — catch-all 500 может быть разовым
+# сетевым сбоем, и пригвождать его на минуту нельзя
+NEG_CACHE_TTL = 60
+_neg_cache = TTLCache(maxsize=4096, ttl=NEG_CACHE_TTL)
+_neg_cache_lock = threading.Lock()
 
 
 class VideoRequest(BaseModel):
@@ -65,87 +88,176 @@ class ProxyDownloadRequest(BaseModel):
     quality: Optional[str] = "best"
 
 
-def get_cache_key(url: str) -> str:
-    return hashlib.md5(url.encode()).hexdigest()
-
+class FormatInfo(BaseModel):
+    format_id: Optional[str] = None
+    ext: str
+    quality: str
+    resolution: Optional[str] = None
+    filesize: Optional[float] = None
+    has_audio: bool
+    has_video: bool
+    height: int
+
+
+class VideoData(BaseModel):
+    id: Optional[str] = None
+    title: Optional[str] = None
+    description: str = ""
+    thumbnail: Optional[str] = None
+    duration: Optional[float] = None
+    uploader: Optional[str] = None
+    view_count: Optional[int] = None
+    webpage_url: Optional[str] = None
+    formats: list[FormatInfo]
+
+
+class VideoInfoResponse(BaseModel):
+    success: bool
+    platform: str
+    data: VideoData
+
+
+# Один проход regex по URL вместо десятка substring-сканов на запрос
+_PLATFORM_RE = re.compile(
+    r'(youtube\.com|youtu\.be|vk\.com|vk\.ru|vkvideo\.ru|tiktok\.com'
+    r'|rutube\.ru|ok\.ru|dzen\.ru)',
+    re.IGNORECASE
+)
 
-def is_cache_valid(cache_entry: dict) -> bool:
-    if not cache_entry:
-        return False
-    return time.time() - cache_entry.get("timestamp", 0) < CACHE_TTL
+_DOMAIN_TO_PLATFORM = {
+    'youtube.com': 'youtube',
+    'youtu.be': 'youtube',
+    'vk.com': 'vk',
+    'vk.ru': 'vk',
+    'vkvideo.ru': 'vk',
+    'tiktok.com': 'tiktok',
+    'rutube.ru': 'rutube',
+    'ok.ru': 'ok',
+    'dzen.ru': 'dzen',
+}
 
 
 def detect_platform(url: str) -> str:
-    url_lower = url.lower()
-    if 'youtube.com' in url_lower or 'youtu.be' in url_lower:
-        return 'youtube'
-    elif 'vk.com' in url_lower or 'vk.ru' in url_lower or 'vkvideo.ru' in url_lower:
-        return 'vk'
-    elif 'tiktok.com' in url_lower:
-        return 'tiktok'
-    elif 'rutube.ru' in url_lower:
-        return 'rutube'
-    elif 'ok.ru' in url_lower:
-        return 'ok'
-    elif 'dzen.ru' in url_lower:
-        return 'dzen'
-    return 'generic'
+    m = _PLATFORM_RE.search(url)
+    return _DOMAIN_TO_PLATFORM[m.group(1).lower()] if m else 'generic'
+
+
+# Всё вне ASCII alnum/пробел/дефис/подчёркивание вырезается из имени файла
+_UNSAFE_FILENAME_RE = re.compile(r'[^A-Za-z0-9 \-_]')
+
+
+_BASE_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'noplaylist': True,
+    'socket_timeout': 60,
+    'retries': 5,
+    'fragment_retries': 5,
+    'extractor_retries': 3,
+    # API отдаёт только метаданные и прямые ссылки — субтитры, комментарии
+    # и само скачивание не нужны, не тратим на них запросы к апстриму
+    'writesubtitles': False,
+    'writeautomaticsub': False,
+    'getcomments': False,
+    'skip_download': True,
+}
+
+_CHROME_UA = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36'
+
+# Опции собраны один раз при импорте; get_ydl_opts возвращает общий dict,
+# поэтому вызывающие не должны его мутировать — только {**opts, ...}
+_PLATFORM_OPTS = {
+    'youtube': {
+        **_BASE_OPTS,
+        'socket_timeout': 90,
+        # Не запрашиваем плеерные конфиги — список форматов они не меняют
+        'extractor_args': {'youtube': {'player_skip': ['configs']}},
+        'http_headers': {
+            'User-Agent': _CHROME_UA,
+            'Accept-Language': 'en-US,en;q=0.9',
+        },
+    },
+    'vk': {
+        **_BASE_OPTS,
+        'http_headers': {
+            'User-Agent': _CHROME_UA,
+            'Accept-Language': 'ru-RU,ru;q=0.9',
+            'Referer': 'https://vk.com/',
+        },
+    },
+    'tiktok': {
+        **_BASE_OPTS,
+        'http_headers': {
+            'User-Agent': 'TikTok 33.0.0 rv:330018 (iPhone; iOS 17.3; en_US) Cronet',
+            'Accept': '*/*',
+        },
+    },
+    'generic': {
+        **_BASE_OPTS,
+        'http_headers': {
+            'User-Agent': _CHROME_UA,
+        },
+    },
+}
 
 
 def get_ydl_opts(platform: str) -> dict:
-    base_opts = {
-        'quiet': True,
-        'no_warnings': True,
-        'noplaylist': True,
-        'socket_timeout': 60,
-        'retries': 5,
-        'fragment_retries': 5,
-        'extractor_retries': 3,
-    }
+    return _PLATFORM_OPTS.get(platform, _PLATFORM_OPTS['generic'])
 
-    chrome_ua = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36'
 
-    if platform == 'youtube':
-        return {
-            **base_opts,
-            'socket_timeout': 90,
-            'http_headers': {
-                'User-Agent': chrome_ua,
-                'Accept-Language': 'en-US,en;q=0.9',
-            },
-        }
-    elif platform == 'vk':
-        return {
-            **base_opts,
-            'http_headers': {
-                'User-Agent': chrome_ua,
-                'Accept-Language': 'ru-RU,ru;q=0.9',
-                'Referer': 'https://vk.com/',
-            },
-        }
-    elif platform == 'tiktok':
-        return {
-            **base_opts,
-            'http_headers': {
-                'User-Agent': 'TikTok 33.0.0 rv:330018 (iPhone; iOS 17.3; en_US) Cronet',
-                'Accept': '*/*',
-            },
-        }
-    else:
-        return {
-            **base_opts,
-            'http_headers': {
-                'User-Agent': chrome_ua,
-            },
-        }
+# Один YoutubeDL на (платформа, формат): переиспользуем его HTTP-соединения
+# вместо нового urllib opener + TLS handshake на каждый запрос. В пул
+# попадают только наши собственные format spec'и (конечный набор), поэтому
+# он ограничен по построению; клиентские format_id сюда не доходят
+_ydl_pool: dict = {}
+_ydl_pool_lock = threading.Lock()
+
+
+def _get_ydl(platform: str, ydl_opts: dict) -> tuple:
+    key = (platform, ydl_opts.get('format'))
+    with _ydl_pool_lock:
+        entry = _ydl_pool.get(key)
+        if entry is None:
+            entry = (yt_dlp.YoutubeDL(ydl_opts), threading.Lock())
+            _ydl_pool[key] = entry
+    return entry
 
 
-def _extract_info_sync(url: str, ydl_opts: dict):
-    """Синхронное извлечение информации о видео."""
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+atexit.register(lambda: [ydl.close() for ydl, _ in _ydl_pool.values()])
+
+
+def _extract_info_sync(url: str, platform: str, ydl_opts: dict, pooled: bool = True):
+    """Синхронное извлечение информации о видео.
+
+    pooled=False — для клиентских format_id: произвольная строка в ключе
+    пула означала бы по новому YoutubeDL на каждое значение без вытеснения,
+    поэтому такие запросы идут через одноразовый инстанс.
+    """
+    if not pooled:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            return ydl.extract_info(url, download=False)
+    ydl, lock = _get_ydl(platform, ydl_opts)
+    # YoutubeDL не потокобезопасен (общие params/cookiejar), поэтому
+    # извлечения на одном инстансе сериализуются: фактический параллелизм
+    # платформы ограничен числом различных ключей пула, а не семафором
+    with lock:
         return ydl.extract_info(url, download=False)
 
 
+# Лимит параллельных извлечений на платформу: медленный YouTube не
+# блокирует запросы к TikTok/VK, а апстрим не видит лишних соединений
+_EXTRACT_SEM = {
+    'youtube': asyncio.Semaphore(2),
+    'vk': asyncio.Semaphore(4),
+    'tiktok': asyncio.Semaphore(8),
+    'generic': asyncio.Semaphore(4),
+}
+
+
+def _extract_sem(platform: str) -> asyncio.Semaphore:
+    return _EXTRACT_SEM.get(platform, _EXTRACT_SEM['generic'])
+
+
 @app.get("/")
 async def root():
     return {
@@ -176,103 +288,111 @@ async def health_check():
         )
 
 
-@app.post("/info")
+@app.post("/info", response_model=VideoInfoResponse)
 async def get_video_info(request: VideoRequest):
     url = request.url
-    cache_key = get_cache_key(url)
 
-    if cache_key in video_cache and is_cache_valid(video_cache[cache_key]):
-        return video_cache[cache_key]["data"]
+    with video_cache_lock:
+        cached = video_cache.get(url)
+    if cached is not None:
+        return cached
+
+    with _neg_cache_lock:
+        neg = _neg_cache.get(url)
+    if neg is not None:
+        raise HTTPException(status_code=neg[0], detail=neg[1])
 
     platform = detect_platform(url)
-    ydl_opts = get_ydl_opts(platform)
-    ydl_opts['extract_flat'] = False
+    ydl_opts = {**get_ydl_opts(platform), 'extract_flat': False}
 
     try:
-        loop = asyncio.get_event_loop()
-        info = await loop.run_in_executor(executor, _extract_info_sync, url, ydl_opts)
+        async with _extract_sem(platform):
+            info = await asyncio.to_thread(_extract_info_sync, url, platform, ydl_opts)
 
         if not info:
             raise HTTPException(status_code=404, detail="Video not found")
 
-        formats = []
+        # Один проход по форматам: лучший формат на каждое качество
+        best: dict = {}
         for f in info.get("formats", []):
             vcodec = f.get("vcodec", "none")
             acodec = f.get("acodec", "none")
 
             if vcodec == "none" and acodec != "none":
-                formats.append({
+                height = 0
+                quality = "audio"
+                entry = {
                     "format_id": f.get("format_id"),
                     "ext": f.get("ext", "mp3"),
-                    "quality": "audio",
+                    "quality": quality,
                     "resolution": "Audio only",
                     "filesize": f.get("filesize") or f.get("filesize_approx"),
                     "has_audio": True,
                     "has_video": False,
-                    "height": 0,
-                })
+                    "height": height,
+                }
             elif vcodec != "none":
                 height = f.get("height", 0) or 0
-                formats.append({
+                if not height:
+                    continue
+                quality = f"{height}p"
+                entry = {
                     "format_id": f.get("format_id"),
                     "ext": f.get("ext", "mp4"),
-                    "quality": f"{height}p" if height else "unknown",
+                    "quality": quality,
                     "resolution": f.get("resolution", f"{height}p"),
                     "filesize": f.get("filesize") or f.get("filesize_approx"),
                     "has_audio": acodec != "none",
                     "has_video": True,
                     "height": height,
-                })
-
-        formats = sorted(
-            [f for f in formats if f.get("height", 0) > 0 or f.get("quality") == "audio"],
-            key=lambda x: x.get("height", 0),
-            reverse=True
+                }
+            else:
+                continue
+
+            if quality not in best:
+                best[quality] = entry
+
+        unique_formats = sorted(best.values(), key=lambda x: x["height"], reverse=True)
+
+        # Готовая модель сериализуется pydantic-core напрямую,
+        # минуя рекурсивный jsonable_encoder
+        result = VideoInfoResponse(
+            success=True,
+            platform=platform,
+            data=VideoData(
+                id=info.get("id"),
+                title=info.get("title", "Unknown"),
+                description=(info.get("description") or "")[:500],
+                thumbnail=info.get("thumbnail"),
+                duration=info.get("duration", 0),
+                uploader=info.get("uploader", "Unknown"),
+                view_count=info.get("view_count"),
+                webpage_url=info.get("webpage_url", url),
+                formats=unique_formats[:10],
+            )
         )
 
-        seen = set()
-        unique_formats = []
-        for f in formats:
-            q = f["quality"]
-            if q not in seen:
-                seen.add(q)
-                unique_formats.append(f)
-
-        result = {
-            "success": True,
-            "platform": platform,
-            "data": {
-                "id": info.get("id"),
-                "title": info.get("title", "Unknown"),
-                "description": (info.get("description") or "")[:500],
-                "thumbnail": info.get("thumbnail"),
-                "duration": info.get("duration", 0),
-                "uploader": info.get("uploader", "Unknown"),
-                "view_count": info.get("view_count"),
-                "webpage_url": info.get("webpage_url", url),
-                "formats": unique_formats[:10],
-            }
-        }
-
-        video_cache[cache_key] = {
-            "data": result,
-            "timestamp": time.time()
-        }
+        with video_cache_lock:
+            video_cache[url] = result
 
         return result
 
     except yt_dlp.DownloadError as e:
         error_msg = str(e)
         if "Sign in" in error_msg or "bot" in error_msg.lower():
-            raise HTTPException(status_code=403, detail="Platform requires authorization")
+            status, detail = 403, "Platform requires authorization"
         elif "Private" in error_msg:
-            raise HTTPException(status_code=403, detail="Video is private")
+            status, detail = 403, "Video is private"
         elif "unavailable" in error_msg.lower():
-            raise HTTPException(status_code=404, detail="Video unavailable or deleted")
+            status, detail = 404, "Video unavailable or deleted"
         elif "geo" in error_msg.lower() or "country" in error_msg.lower():
-            raise HTTPException(status_code=403, detail="Video not available in your region")
+            status, detail = 403, "Video not available in your region"
         else:
-            raise HTTPException(status_code=500, detail=f"Extraction error: {error_msg[:200]}")
+            status, detail = 500, f"Extraction error: {error_msg[:200]}"
+        if status != 500:
+            with _neg_cache_lock:
+                _neg_cache[url] = (status, detail)
+        raise HTTPException(status_code=status, detail=detail)
     except HTTPException:
         raise
     except Exception as e:
@@ -285,8 +405,12 @@ async def get_download_url(request: DownloadRequest):
     format_id = request.format_id
     quality = request.quality or "best"
 
+    with _neg_cache_lock:
+        neg = _neg_cache.get(url)
+    if neg is not None:
+        raise HTTPException(status_code=neg[0], detail=neg[1])
+
     platform = detect_platform(url)
-    ydl_opts = get_ydl_opts(platform)
 
     if format_id:
         format_spec = format_id
@@ -300,11 +424,12 @@ async def get_download_url(request: DownloadRequest):
     else:
         format_spec = "best"
 
-    ydl_opts['format'] = format_spec
+    ydl_opts = {**get_ydl_opts(platform), 'format': format_spec}
 
     try:
-        loop = asyncio.get_event_loop()
-        info = await loop.run_in_executor(executor, _extract_info_sync, url, ydl_opts)
+        async with _extract_sem(platform):
+            info = await asyncio.to_thread(_extract_info_sync, url, platform, ydl_opts,
+                                           pooled=format_id is None)
 
         if not info:
             raise HTTPException(status_code=404, detail="Video not found")
@@ -358,13 +483,17 @@ async def get_download_url(request: DownloadRequest):
     except yt_dlp.DownloadError as e:
         error_msg = str(e)
         if "Sign in" in error_msg or "bot" in error_msg.lower():
-            raise HTTPException(status_code=403, detail="Platform requires authorization")
+            status, detail = 403, "Platform requires authorization"
         elif "Private" in error_msg:
-            raise HTTPException(status_code=403, detail="Video is private")
+            status, detail = 403, "Video is private"
         elif "unavailable" in error_msg.lower():
-            raise HTTPException(status_code=404, detail="Video unavailable")
+            status, detail = 404, "Video unavailable"
         else:
-            raise HTTPException(status_code=500, detail=f"Error: {error_msg[:200]}")
+            status, detail = 500, f"Error: {error_msg[:200]}"
+        if status != 500:
+            with _neg_cache_lock:
+                _neg_cache[url] = (status, detail)
+        raise HTTPException(status_code=status, detail=detail)
     except HTTPException:
         raise
     except Exception as e:
@@ -382,7 +511,6 @@ async def proxy_download(request: ProxyDownloadRequest):
     quality = request.quality or "best"
 
     platform = detect_platform(url)
-    ydl_opts = get_ydl_opts(platform)
 
     # Для прокси нужны форматы с видео+аудио в одном файле
     # YouTube разделяет потоки, поэтому выбираем комбинированные форматы
@@ -407,12 +535,13 @@ async def proxy_download(request: ProxyDownloadRequest):
     else:
         format_spec = "best[ext=mp4]/best"
 
-    ydl_opts['format'] = format_spec
+    ydl_opts = {**get_ydl_opts(platform), 'format': format_spec}
 
     try:
         # Получаем URL для скачивания
-        loop = asyncio.get_event_loop()
-        info = await loop.run_in_executor(executor, _extract_info_sync, url, ydl_opts)
+        async with _extract_sem(platform):
+            info = await asyncio.to_thread(_extract_info_sync, url, platform, ydl_opts,
+                                           pooled=format_id is None)
 
         if not info:
             raise HTTPException(status_code=404, detail="Video not found")
@@ -429,7 +558,7 @@ async def proxy_download(request: ProxyDownloadRequest):
 
         title = info.get("title", "video")
         # Удаляем все не-ASCII символы для имени файла
-        safe_title = "".join(c for c in title if c.isascii() and (c.isalnum() or c in (' ', '-', '_'))).strip()[:50]
+        safe_title = _UNSAFE_FILENAME_RE.sub('', title).strip()[:50]
         if not safe_title:
             safe_title = "video"
         ext = info.get("ext", "mp4")
@@ -441,18 +570,9 @@ async def proxy_download(request: ProxyDownloadRequest):
         headers['Accept'] = '*/*'
         headers['Accept-Encoding'] = 'identity'
 
-        # Проксируем стрим от CDN к клиенту
-        async def stream_proxy():
-            try:
-                async with http_client.stream('GET', download_url, headers=headers) as response:
-                    async for chunk in response.aiter_bytes(chunk_size=256 * 1024):
-                        yield chunk
-            except Exception as e:
-                print(f"Proxy stream error: {e}")
-
         # Получаем размер файла если возможно
         try:
-            head_response = await http_client.head(download_url, headers=headers)
+            head_response = await app.state.http.head(download_url, headers=headers)
             content_length = head_response.headers.get('content-length')
         except:
             content_length = None
@@ -476,6 +596,19 @@ async def proxy_download(request: ProxyDownloadRequest):
         elif ext == "mp3":
             media_type = "audio/mpeg"
 
+        # Проксируем стрим от CDN к клиенту: чанки aiter_raw идут без
+        # лишней копии, а finally закрывает апстрим на любом исходе —
+        # BackgroundTask не выполняется, если итератор тела упал
+        cdn_request = app.state.http.build_request('GET', download_url, headers=headers)
+        cdn_response = await app.state.http.send(cdn_request, stream=True)
+
+        async def stream_proxy():
+            try:
+                async for chunk in cdn_response.aiter_raw(256 * 1024):
+                    yield chunk
+            finally:
+                await cdn_response.aclose()
+
         return StreamingResponse(
             stream_proxy(),
             media_type=media_type,
@@ -498,11 +631,6 @@ async def proxy_download(request: ProxyDownloadRequest):
         raise HTTPException(status_code=500, detail=f"Error: {str(e)[:200]}")
 
 
-@app.on_event("shutdown")
-async def shutdown_event():
-    await http_client.aclose()
-
-
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8000))